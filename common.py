@@ -1,9 +1,11 @@
 # This file contains modules common to various models
-import math
+from collections import OrderedDict
+from functools import reduce
 
 import torch
 import torch.nn as nn
-from utils.general import non_max_suppression
+import torchvision
+from utils.general import xywh2xyxy
 '''
 feature map尺寸计算公式： out_size = (in_size + 2*Padding - kernel_size)/strides + 1
 卷积计算时map尺寸向下取整
@@ -22,6 +24,100 @@ def autopad(k, p=None):  # kernel, padding
         p = k // 2 if isinstance(k, int) else [x // 2 for x in k]  # auto-pad
     return p
 
+def _fuse_conv_bn(conv, bn, sl=slice(None)):
+    '''
+    将BN层融合进卷积层，返回带bias的新卷积层：
+        W_hat = (γ / √(σ² + ε)) · W
+        b_hat = β - γ·μ / √(σ² + ε)
+    conv : nn.Conv2d (bias可有可无)
+    bn : nn.BatchNorm2d
+    sl : conv输出通道在bn中对应的通道切片（BN作用于多个卷积输出的concat时使用）
+    '''
+    with torch.no_grad():
+        fusedconv = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                              dilation=conv.dilation, groups=conv.groups, bias=True).to(conv.weight.device, conv.weight.dtype)
+        scale = bn.weight[sl] / torch.sqrt(bn.running_var[sl] + bn.eps)  # γ/√(σ²+ε)
+        fusedconv.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        b_conv = torch.zeros_like(scale) if conv.bias is None else conv.bias
+        fusedconv.bias.copy_((b_conv - bn.running_mean[sl]) * scale + bn.bias[sl])
+    return fusedconv.requires_grad_(False)
+
+def _is_channels_last(x):
+    '''
+    x是否为channels_last(NHWC)内存布局（同时满足NCHW连续的退化情况视为NCHW）
+    '''
+    return not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last)
+
+def _memory_format(x):
+    '''
+    返回x的内存布局，用于按输入布局分配推理缓存
+    '''
+    return torch.channels_last if _is_channels_last(x) else torch.contiguous_format
+
+def _inference_cache_enabled():
+    '''
+    是否使用推理缓存（out=写入复用的张量）：需无梯度，且不在jit trace或torch.compile过程中
+    out=不支持反向传播/trace；compile区域内对属性张量的写入会被视为输入被修改，导致CUDA graphs失效
+    '''
+    if torch.is_grad_enabled() or torch.jit.is_tracing():
+        return False
+    is_compiling = getattr(getattr(torch, 'compiler', None), 'is_compiling', None)  # torch>=2.3
+    if is_compiling is None and hasattr(torch, 'compile'):  # torch 2.0~2.2
+        import torch._dynamo
+        is_compiling = torch._dynamo.is_compiling
+    return not (is_compiling is not None and is_compiling())
+
+def _is_inference(x):  # torch>=1.9
+    return x.is_inference() if hasattr(x, 'is_inference') else False
+
+def _inference_mode_enabled():  # torch>=1.9
+    return torch.is_inference_mode_enabled() if hasattr(torch, 'is_inference_mode_enabled') else False
+
+def _reuse(buf, shape, like, fmt=torch.contiguous_format, dtype=None):
+    '''
+    返回可复用的推理缓存：buf的尺寸/精度/设备/内存布局都与要求一致时直接返回buf，
+    否则（或buf为None时）按like所在设备重新分配
+    shape : 缓存尺寸
+    like : 决定设备（以及默认精度）的张量
+    fmt : 内存布局，一般为_memory_format(输入)
+    dtype : 精度，默认为like.dtype
+    torch.inference_mode()中分配的缓存是inference tensor，之后在no_grad下不能作为out=写入，
+    因此缓存是否为inference tensor与当前是否处于inference_mode不一致时也重新分配
+    '''
+    dtype = like.dtype if dtype is None else dtype
+    if buf is None or buf.shape != shape or buf.dtype != dtype or buf.device != like.device \
+            or not buf.is_contiguous(memory_format=fmt) or _is_inference(buf) != _inference_mode_enabled():
+        buf = torch.empty(shape, dtype=dtype, device=like.device, memory_format=fmt)
+    return buf
+
+class _CacheModule(nn.Module):
+    '''
+    带推理缓存的模块基类
+        _cache_attrs : {缓存属性名: 空值}，空值可调用时调用它生成（如OrderedDict）
+        缓存不参与pickle保存/深拷贝；加载旧版本pickle保存的模型（没有缓存属性）时补上空缓存
+    '''
+    _cache_attrs = {}
+
+    def __init__(self):
+        super(_CacheModule, self).__init__()
+        self.clear_cache()
+
+    def _empty_cache(self):
+        return {k: v() if callable(v) else v for k, v in self._cache_attrs.items()}
+
+    def clear_cache(self):  # 释放推理缓存
+        self.__dict__.update(self._empty_cache())
+
+    def __getstate__(self):  # 推理缓存不参与保存/深拷贝
+        state = self.__dict__.copy()
+        state.update(self._empty_cache())
+        return state
+
+    def __setstate__(self, state):  # 兼容旧版本pickle保存的模型（没有推理缓存属性）
+        super(_CacheModule, self).__setstate__(state)
+        for k, v in self._empty_cache().items():
+            self.__dict__.setdefault(k, v)
+
 def DWConv(c1, c2, k=1, s=1, act=True):
     '''
     深度分离卷积层 Depthwise convolution：
@@ -32,10 +128,13 @@ def DWConv(c1, c2, k=1, s=1, act=True):
         k : kernel_size
         s : stride
         act : 是否使用激活函数
-        math.gcd() 返回的是最大公约数
+        c1 != c2 时拆分为 depthwise(c1->c1, g=c1) + pointwise 1×1(c1->c2)，
+        只有 groups == in_channels == out_channels 时cuDNN/oneDNN才会使用专门优化的depthwise卷积
     '''
     # Depthwise convolution
-    return Conv(c1, c2, k, s, g=math.gcd(c1, c2), act=act)
+    if c1 == c2:
+        return Conv(c1, c2, k, s, g=c1, act=act)
+    return nn.Sequential(Conv(c1, c1, k, s, g=c1, act=False), Conv(c1, c2, 1, 1, act=act))
 
 class Conv(nn.Module):
     '''
@@ -49,7 +148,7 @@ class Conv(nn.Module):
         super(Conv, self).__init__()
         self.conv = nn.Conv2d(c1, c2, k, s, autopad(k, p), groups=g, bias=False)
         self.bn = nn.BatchNorm2d(c2)
-        self.act = nn.Hardswish() if act else nn.Identity()
+        self.act = nn.Hardswish(inplace=True) if act else nn.Identity()  # 作用于BN/conv新生成的输出，inplace安全
 
     def forward(self, x):  # 前向计算（有BN）
         return self.act(self.bn(self.conv(x)))
@@ -57,6 +156,15 @@ class Conv(nn.Module):
     def fuseforward(self, x):  # 前向融合计算（无BN）
         return self.act(self.conv(x))
 
+    def fuse_conv_bn(self):
+        '''
+        推理阶段将BN层融合进Conv2d，bn替换为nn.Identity，forward替换为fuseforward
+        '''
+        self.conv = _fuse_conv_bn(self.conv, self.bn)
+        self.bn = nn.Identity()
+        self.forward = self.fuseforward
+        return self
+
 class Bottleneck(nn.Module):
     '''
     标准Bottleneck层
@@ -82,13 +190,15 @@ class Bottleneck(nn.Module):
         '''
         return x + self.cv2(self.cv1(x)) if self.add else self.cv2(self.cv1(x))
 
-class BottleneckCSP(nn.Module):
+class BottleneckCSP(_CacheModule):
     '''
     标准ottleneckCSP层
     (self, in_channels, out_channels, Bottleneck层重复次数, shortcut_flag, group, expansion隐藏神经元的缩放因子)
     out_size = in_size
     '''
     # CSP Bottleneck https://github.com/WongKinYiu/CrossStagePartialNetworks
+    _cache_attrs = {'_cat_buf': None}  # 推理时复用的concat输出缓存
+
     def __init__(self, c1, c2, n=1, shortcut=True, g=1, e=0.5):  # ch_in, ch_out, number, shortcut, groups, expansion
         super(BottleneckCSP, self).__init__()
         c_ = int(c2 * e)  # hidden channels
@@ -100,15 +210,47 @@ class BottleneckCSP(nn.Module):
         self.act = nn.LeakyReLU(0.1, inplace=True)
         self.m = nn.Sequential(*[Bottleneck(c_, c_, shortcut, g, e=1.0) for _ in range(n)])
 
+    def _cat(self, y1, y2):
+        '''
+        concat(y1, y2)
+        推理时（无梯度）直接写入复用的缓存，避免每次前向重新分配2*c_通道的张量；
+        训练或导出时out=不支持反向传播/trace，仍使用torch.cat
+        '''
+        if not _inference_cache_enabled():
+            return torch.cat((y1, y2), dim=1)
+        b, c1, h, w = y1.shape
+        buf = self._cat_buf = _reuse(self._cat_buf, (b, c1 + y2.shape[1], h, w), y1, _memory_format(y1))
+        return torch.cat((y1, y2), dim=1, out=buf)
+
     def forward(self, x):
         y1 = self.cv3(self.m(self.cv1(x)))   # CONV + BottleNeck + Conv2d  out_channels = c_
         y2 = self.cv2(x)  # Conv2d   out_channels = c_
-        return self.cv4(self.act(self.bn(torch.cat((y1, y2), dim=1))))  # concat(y1 + y2) + BN + LeakyReLU + Conv2d  out_channels = c2
+        return self.cv4(self.act(self.bn(self._cat(y1, y2))))  # concat(y1 + y2) + BN + LeakyReLU + Conv2d  out_channels = c2
+
+    def fuseforward(self, x):  # 前向融合计算（BN已融合进cv3、cv2）
+        y1 = self.cv3(self.m(self.cv1(x)))
+        y2 = self.cv2(x)
+        return self.cv4(self.act(self._cat(y1, y2)))  # concat(y1 + y2) + LeakyReLU(inplace，直接作用于缓存) + Conv2d
+
+    def fuse(self):
+        '''
+        推理阶段将concat之后的BN层拆分融合进cv3（前c_个通道）和cv2（后c_个通道），
+        bn替换为nn.Identity，forward替换为fuseforward
+        '''
+        c_ = self.cv3.out_channels
+        self.cv3 = _fuse_conv_bn(self.cv3, self.bn, slice(0, c_))  # y1 = cv3(...) 位于concat的前半部分
+        self.cv2 = _fuse_conv_bn(self.cv2, self.bn, slice(c_, 2 * c_))  # y2 = cv2(x) 位于concat的后半部分
+        self.bn = nn.Identity()
+        self.forward = self.fuseforward
+        return self
 
 class SPP(nn.Module):
     '''
     空间金字塔池化SPP：
     (self, in_channels, out_channels, 池化尺寸strides[3])
+    n次串联的 k0×k0 最大池化(stride=1) 等价于 n*(k0-1)+1 的最大池化，
+    因此5×5 9×9 13×13的池化结果可由3次串联的5×5池化依次得到，每次只读取上一次的结果；
+    池化尺寸不满足该关系时仍分别做各尺寸的池化
     '''
     # Spatial pyramid pooling layer used in YOLOv3-SPP
     def __init__(self, c1, c2, k=(5, 9, 13)):
@@ -116,42 +258,120 @@ class SPP(nn.Module):
         c_ = c1 // 2  # hidden channels
         self.cv1 = Conv(c1, c_, 1, 1)
         self.cv2 = Conv(c_ * (len(k) + 1), c2, 1, 1)
-        # 建立5×5 9×9 13×13的最大池化处理过程的list
-        self.m = nn.ModuleList([nn.MaxPool2d(kernel_size=x, stride=1, padding=x // 2) for x in k])
+        if all(x == (i + 1) * (k[0] - 1) + 1 for i, x in enumerate(k)):  # 可串联
+            self.n = len(k)
+            self.m = nn.MaxPool2d(kernel_size=k[0], stride=1, padding=k[0] // 2)
+        else:
+            # 建立各尺寸最大池化处理过程的list
+            self.m = nn.ModuleList([nn.MaxPool2d(kernel_size=x, stride=1, padding=x // 2) for x in k])
 
     def forward(self, x):
         x = self.cv1(x)
-        return self.cv2(torch.cat([x] + [m(x) for m in self.m], 1))
+        if isinstance(self.m, nn.ModuleList):  # 不可串联的池化尺寸（以及旧版本pickle保存的模型）
+            return self.cv2(torch.cat([x] + [m(x) for m in self.m], 1))
+        y = [x]
+        for _ in range(self.n):
+            y.append(self.m(y[-1]))  # 感受野依次为 5, 9, 13
+        return self.cv2(torch.cat(y, 1))
+
+def _double(v):
+    '''
+    int或(h, w)序列逐元素乘2（kernel_size/stride/padding）
+    '''
+    return 2 * v if isinstance(v, int) else [2 * x for x in v]
 
 class Focus(nn.Module):
     '''
     Focus : 把宽度w和高度h的信息整合到c空间中
     (self, in_channels, out_channels, kernel_size, stride, padding, group, activation_flag)
+    切片+concat后做 k×k、stride=s、padding=p 的卷积，等价于在原图上直接做 2k×2k、stride=2s、padding=2p 的卷积，
+    省去4次跨步切片和4倍通道的concat
     '''
     # Focus wh information into c-space
     def __init__(self, c1, c2, k=1, s=1, p=None, g=1, act=True):  # ch_in, ch_out, kernel, stride, padding, groups
         super(Focus, self).__init__()
-        self.conv = Conv(c1 * 4, c2, k, s, p, g, act)
+        self.conv = Conv(c1, c2, _double(k), _double(s), _double(autopad(k, p)), g, act)
+        self.space_to_depth = False  # True: 旧版无法转换的模型(groups>1)，仍先切片再卷积
 
-    def forward(self, x):
+    def __setstate__(self, state):
         '''
-        x(batch_size, channels, height, width) -> y(batch_size, 4*channels, height/2, weight/2)
+        兼容旧版本pickle保存的模型：其conv为切片版本的Conv(4*c1, ...)，
+        groups == 1时就地转换为等价的 2k×2k 卷积，否则保留切片计算
         '''
-        # ::代表[start:end:step], 以2为步长取值
-        return self.conv(torch.cat([x[..., ::2, ::2], x[..., 1::2, ::2], x[..., ::2, 1::2], x[..., 1::2, 1::2]], 1))
+        super(Focus, self).__setstate__(state)
+        if 'space_to_depth' in state:
+            return
+        conv = self.conv.conv
+        self.space_to_depth = conv.groups != 1
+        if self.space_to_depth:
+            return
+        with torch.no_grad():
+            fusedconv = nn.Conv2d(conv.in_channels // 4, conv.out_channels, _double(conv.kernel_size), _double(conv.stride),
+                                  _double(conv.padding), bias=conv.bias is not None).to(conv.weight.device, conv.weight.dtype)
+            fusedconv.weight.copy_(self._unfold_weight(conv.weight))
+            if conv.bias is not None:
+                fusedconv.bias.copy_(conv.bias)
+        self.conv.conv = fusedconv.requires_grad_(conv.weight.requires_grad)
 
-class Concat(nn.Module):
+    @staticmethod
+    def _unfold_weight(w):
+        '''
+        将切片版本的conv权重(c2, 4*c1, kh, kw)重排为(c2, c1, 2kh, 2kw)
+        旧的4组通道依次为 x[::2, ::2], x[1::2, ::2], x[::2, 1::2], x[1::2, 1::2]，即下标顺序为(dx, dy, c)
+        new_w[:, c, 2u+dy, 2v+dx] = old_w[:, (2*dx+dy)*c1+c, u, v]
+        '''
+        c2, c4, kh, kw = w.shape
+        w = w.view(c2, 2, 2, c4 // 4, kh, kw)  # (c2, dx, dy, c1, u, v)
+        return w.permute(0, 3, 4, 2, 5, 1).reshape(c2, c4 // 4, 2 * kh, 2 * kw)  # (c2, c1, u, dy, v, dx)
+
+    def forward(self, x):
+        '''
+        x(batch_size, channels, height, width) -> y(batch_size, out_channels, height/(2*s), weight/(2*s))
+        '''
+        if self.space_to_depth:  # ::代表[start:end:step], 以2为步长取值
+            x = torch.cat([x[..., ::2, ::2], x[..., 1::2, ::2], x[..., ::2, 1::2], x[..., 1::2, 1::2]], 1)
+        return self.conv(x)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容旧权重(state_dict)：切片版本的conv权重重排为等价的 2k×2k 卷积权重
+        key = prefix + 'conv.conv.weight'
+        w = state_dict.get(key)
+        if w is not None and not self.space_to_depth and self.conv.conv.groups == 1 \
+                and w.shape[1] == 4 * self.conv.conv.in_channels:
+            state_dict[key] = self._unfold_weight(w)
+        super(Focus, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+class Concat(_CacheModule):
     '''
     (dimension)
     默认d=1按列拼接 ， d=0则按行拼接
     '''
     # Concatenate a list of tensors along dimension
+    cache_size = 4  # 每个Concat最多缓存的输出尺寸数（LRU）
+    _cache_attrs = {'_buf_cache': OrderedDict}  # 推理时按(输入尺寸, 精度, 设备, 内存布局)复用的输出缓存
+
     def __init__(self, dimension=1):
         super(Concat, self).__init__()
         self.d = dimension
 
     def forward(self, x):
-        return torch.cat(x, self.d)
+        '''
+        推理时（无梯度）返回的是持久缓存：下一次相同输入尺寸的无梯度前向会覆盖其内容，
+        需要保留结果时请先clone()
+        '''
+        if not _inference_cache_enabled():
+            return torch.cat(x, self.d)
+        fmt = _memory_format(x[0])
+        key = tuple((t.shape, t.dtype) for t in x) + (x[0].device, fmt)
+        buf = self._buf_cache.pop(key, None)
+        if buf is None and len(self._buf_cache) >= self.cache_size:
+            self._buf_cache.popitem(last=False)  # 丢弃最久未使用的缓存
+        shape = list(x[0].shape)
+        shape[self.d] = sum(t.shape[self.d] for t in x)
+        # 与输入相同的内存布局，channels_last模型不会被转回NCHW
+        buf = _reuse(buf, torch.Size(shape), x[0], fmt, reduce(torch.promote_types, (t.dtype for t in x)))
+        self._buf_cache[key] = buf  # 最近使用的放到末尾
+        return torch.cat(x, self.d, out=buf)
 
 
 class NMS(nn.Module):
@@ -159,12 +379,46 @@ class NMS(nn.Module):
     conf = 0.3  # confidence threshold
     iou = 0.6  # IoU threshold
     classes = None  # (optional list) filter by class
+    angle = 180  # number of angle bins following the class scores (Detect.angle)
+    max_det = 300  # maximum number of detections per image
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.batched_nms()
 
     def __init__(self, dimension=1):
         super(NMS, self).__init__()
 
     def forward(self, x):
-        return non_max_suppression(x[0], conf_thres=self.conf, iou_thres=self.iou, classes=self.classes)
+        '''
+        x[0] : (batch_size, num_boxes, 5 + num_classes + angle)  [xywh, obj_conf, cls_conf..., angle_conf...]
+        整个batch只调用一次torchvision.ops.batched_nms：idxs = 图像序号 * num_classes + 类别，
+        不同图像、不同类别的框之间互不抑制，全部计算留在GPU上
+        return : list，每张图像的检测结果 (n, 6)  [xyxy, conf, cls]
+        '''
+        prediction = x[0]
+        bs, nc = prediction.shape[0], prediction.shape[2] - 5 - self.angle
+        bi, j = (prediction[..., 4] > self.conf).nonzero(as_tuple=True)  # 候选框所在的图像序号, 框序号
+        p = prediction[bi, j].float()  # batched_nms按idxs给框加坐标偏移，FP16下偏移后的坐标精度不足，统一用FP32计算
+        scores = p[:, 5:5 + nc] * p[:, 4:5]  # conf = obj_conf * cls_conf
+        r, cls = (scores > self.conf).nonzero(as_tuple=True)  # 多标签：每个超过阈值的(框, 类别)各作为一个候选
+        if self.classes is not None:  # 按类别筛选
+            keep = (cls[:, None] == torch.tensor(self.classes, device=cls.device)).any(1)
+            r, cls = r[keep], cls[keep]
+        bi, conf, boxes = bi[r], scores[r, cls], xywh2xyxy(p[r, :4])
+
+        counts = torch.bincount(bi, minlength=bs)  # 每张图像的候选框数
+        if len(bi) and counts.max() > self.max_nms:  # 每张图像只保留分数最高的max_nms个候选框
+            order = conf.argsort(descending=True)
+            order = order[bi[order].sort(stable=True)[1]]  # 按图像序号排列，图像内保持分数降序
+            rank = torch.arange(len(order), device=bi.device) - (counts.cumsum(0) - counts)[bi[order]]
+            order = order[rank < self.max_nms]
+            bi, conf, cls, boxes = bi[order], conf[order], cls[order], boxes[order]
+
+        i = torchvision.ops.batched_nms(boxes, conf, bi * nc + cls, self.iou)  # 按分数降序返回保留的框
+        det, bi = torch.cat((boxes[i], conf[i, None], cls[i, None].float()), 1), bi[i]
+        return [det[bi == k][:self.max_det] for k in range(bs)]
+
+@torch.jit.script
+def _flatten(x):
+    return x.reshape(x.size(0), -1)  # 连续输入时等同于view；非连续输入时拷贝一次而不是报错
 
 class Flatten(nn.Module):
     '''
@@ -172,9 +426,7 @@ class Flatten(nn.Module):
     (batch_size, channels, size, size) -> (batch_size, channels*size*size)
     '''
     # Use after nn.AdaptiveAvgPool2d(1) to remove last 2 dimensions
-    @staticmethod
-    def forward(x):
-        return x.view(x.size(0), -1)
+    forward = staticmethod(_flatten)
 
 class Classify(nn.Module):
     '''
@@ -190,11 +442,14 @@ class Classify(nn.Module):
         self.flat = Flatten()
 
     def forward(self, x):
-        #
-        z = torch.cat([self.aap(y) for y in (x if isinstance(x, list) else [x])], 1)  # cat if x is list
-        return self.flat(self.conv(z))  # flatten to x(batch_size, ch_out×1×1)
+        if isinstance(x, list):  # aap(cat(x)) == cat(aap(y) for y in x)，空间尺寸相同时先cat，只做一次池化
+            x = torch.cat(x, 1) if len({y.shape[-2:] for y in x}) == 1 else torch.cat([self.aap(y) for y in x], 1)
+        return self.flat(self.conv(self.aap(x)))  # flatten to x(batch_size, ch_out×1×1)
+
+class SpatialAttention(_CacheModule):
+    _cache_attrs = {'_buf': None,  # 推理时复用的[mean, max]缓存 (B, 2, H, W)
+                    '_idx': None}  # torch.max输出的索引缓存 (B, 1, H, W)
 
-class SpatialAttention(nn.Module):
     def __init__(self, kernel_size=7):
         super(SpatialAttention, self).__init__()
         self.conv1 = nn.Conv2d(2, 1, kernel_size=kernel_size,
@@ -202,9 +457,17 @@ class SpatialAttention(nn.Module):
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
-        avg_out = torch.mean(x, dim=1,keepdim=True)
-        max_out,_ = torch.max(x, dim=1,keepdim=True)
-        out = torch.cat([avg_out,max_out], dim=1)
+        if not _inference_cache_enabled():
+            avg_out = torch.mean(x, dim=1,keepdim=True)
+            max_out,_ = torch.max(x, dim=1,keepdim=True)
+            out = torch.cat([avg_out,max_out], dim=1)
+        else:  # 推理时mean、max直接写入缓存的两个通道，省去cat
+            b, _, h, w = x.shape
+            fmt = _memory_format(x)
+            out = self._buf = _reuse(self._buf, (b, 2, h, w), x, fmt)
+            self._idx = _reuse(self._idx, (b, 1, h, w), x, fmt, torch.long)
+            torch.mean(x, dim=1, keepdim=True, out=out[:, 0:1])
+            torch.max(x, dim=1, keepdim=True, out=(out[:, 1:2], self._idx))
         out = self.conv1(out)
         return self.sigmoid(out)
 
@@ -221,8 +484,9 @@ class ChannelAttention(nn.Module):
         self.sigmoid = nn.Sigmoid()
 
     def forward(self,x):
-        avg_out = self.fc(self.avg_pool(x))
-        max_out = self.fc(self.max_pool(x))
+        # avg、max两路共享fc，沿batch维拼接后只做一次fc: (2B, C, 1, 1)
+        out = self.fc(torch.cat([self.avg_pool(x), self.max_pool(x)], dim=0))
+        avg_out, max_out = out.chunk(2, dim=0)
         out = avg_out + max_out
         return self.sigmoid(out)
 
@@ -234,6 +498,8 @@ class CBAM(nn.Module):
 
     def forward(self, x):
         x = self.channel_attn(x)*x
+        if not torch.is_grad_enabled():  # 推理时x为上一步新生成的张量，直接原地相乘，少分配一个完整特征图
+            return x.mul_(self.sptial_attn(x))
         y = self.sptial_attn(x)*x
         return y
 
@@ -248,11 +514,14 @@ class SAM(nn.Module):
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
-        xh = x.transpose(-2, -3)
-        xw = x.transpose(-1, -3)
-
-        yh = self.ham(xh)
-        yw = self.wam(xw)
+        '''
+        ham/wam为1×1卷积，即分别沿H、W维做线性变换，直接用einsum在原始布局上计算，
+        避免 x.transpose(-2, -3)、x.transpose(-1, -3) 送入Conv2d时产生的两次连续化拷贝
+            yh = ham(x.transpose(-2, -3)) : (B, C, H, W) -> (B, in_channels, C, W)
+            yw = wam(x.transpose(-1, -3)) : (B, C, H, W) -> (B, in_channels, H, C)
+        '''
+        yh = torch.einsum('oh,bchw->bocw', self.ham.weight.flatten(1), x) + self.ham.bias.view(1, -1, 1, 1)
+        yw = torch.einsum('ow,bchw->bohc', self.wam.weight.flatten(1), x) + self.wam.bias.view(1, -1, 1, 1)
 
         y = yw @ yh
         y = self.sigmoid(y)
@@ -268,40 +537,141 @@ class DAM(nn.Module):
 
     def forward(self, x):
         x = self.cam(x) * x
-        y = self.sam(x) * x
+        y = x * self.sam(x)  # x在前，使输出沿用x的内存布局（SAM的matmul输出为NCHW）
         return y
 
-def window_partition(x, window_size):
-    x = x.permute(0, 2, 3, 1)
-    B,H,W,C = x.shape
-    x = x.view(B, H // window_size, window_size, W // window_size, window_size, C)
-    windows = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, window_size, window_size, C)
-    windows = windows.permute(0, 3, 1, 2)
-    return windows
-
-def window_reverse(windows, window_size, H, W):
-    windows = windows.permute(0, 2, 3, 1)
-    B = int(windows.shape[0] / (H * W / window_size / window_size))
-    x = windows.view(B, H // window_size, W // window_size, window_size, window_size, -1)
-    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
-    x = x.permute(0, 3, 1, 2)
-    return x
-
+def window_partition(x, window_size, nH=None, nW=None):
+    '''
+    (B, C, H, W) -> (B*H/ws*W/ws, C, ws, ws)，窗口按(b, h方向序号, w方向序号)排列
+    直接在原布局上view+permute，只在最后的reshape中拷贝一次；输出窗口保持输入的内存布局(NCHW/channels_last)
+    nH, nW : 可选，预先计算好的 H/ws、W/ws
+    '''
+    B, C, H, W = x.shape
+    if nH is None:
+        nH, nW = H // window_size, W // window_size
+    channels_last = _is_channels_last(x)
+    x = x.view(B, C, nH, window_size, nW, window_size)
+    if channels_last:  # 按NHWC顺序拷贝，C维保持连续
+        return x.permute(0, 2, 4, 3, 5, 1).reshape(-1, window_size, window_size, C).permute(0, 3, 1, 2)
+    return x.permute(0, 2, 4, 1, 3, 5).reshape(-1, C, window_size, window_size)
+
+def window_reverse(windows, window_size, H, W, nH=None, nW=None, out=None):
+    '''
+    window_partition的逆过程：(B*H/ws*W/ws, C, ws, ws) -> (B, C, H, W)，输出保持windows的内存布局
+    nH, nW : 可选，预先计算好的 H/ws、W/ws
+    out : 可选，与windows内存布局相同的(B, C, H, W)输出缓存，结果直接拷贝进out
+    '''
+    if nH is None:
+        nH, nW = H // window_size, W // window_size
+    B, C = windows.shape[0] // (nH * nW), windows.shape[1]
+    if _is_channels_last(windows):
+        x = windows.permute(0, 2, 3, 1).view(B, nH, nW, window_size, window_size, C).permute(0, 1, 3, 2, 4, 5)
+        if out is None:
+            return x.reshape(B, H, W, C).permute(0, 3, 1, 2)
+        out.permute(0, 2, 3, 1).view(B, nH, window_size, nW, window_size, C).copy_(x)
+        return out
+    x = windows.view(B, nH, nW, C, window_size, window_size).permute(0, 3, 1, 4, 2, 5)
+    if out is None:
+        return x.reshape(B, C, H, W)
+    out.view(B, C, nH, window_size, nW, window_size).copy_(x)
+    return out
+
+
+class BDAM(_CacheModule):
+    _cache_attrs = {'_out_buf': None}  # 推理时复用的window_reverse输出缓存
 
-class BDAM(nn.Module):
     def __init__(self, in_planes, width, height):
         super(BDAM, self).__init__()
         self.width = width
         self.height= height
         self.window_size = min(self.width // 4, self.height //4)
+        self.nH, self.nW = self.height // self.window_size, self.width // self.window_size  # 窗口行数、列数
         self.dam = DAM(in_planes, self.window_size, self.window_size)
 
+    def __setstate__(self, state):  # 兼容旧版本pickle保存的模型（没有窗口行列数属性）
+        super(BDAM, self).__setstate__(state)
+        self.__dict__.setdefault('nH', self.height // self.window_size)
+        self.__dict__.setdefault('nW', self.width // self.window_size)
+
+    def _out(self, windows):
+        '''
+        推理时（无梯度）返回复用的(B, C, H, W)输出缓存，batch size/精度/设备/内存布局改变时重新分配；
+        训练或导出时返回None，由window_reverse新建输出
+        '''
+        if not _inference_cache_enabled():
+            return None
+        shape = (windows.shape[0] // (self.nH * self.nW), windows.shape[1], self.height, self.width)
+        self._out_buf = _reuse(self._out_buf, shape, windows, _memory_format(windows))
+        return self._out_buf
+
     def forward(self, x):
-        x = window_partition(x, self.window_size)
-        x = self.dam(x)
-        y  = window_reverse(x,self.window_size, H=self.height, W=self.width)
+        '''
+        推理时（无梯度）返回的是持久缓存self._out_buf：下一次无梯度前向会覆盖其内容，
+        需要保留结果时请先clone()
+        '''
+        ws, nH, nW = self.window_size, self.nH, self.nW
+        x = window_partition(x, ws, nH, nW)
+        x = self.dam(x)  # 每个窗口分别计算通道注意力与空间注意力
+        y  = window_reverse(x, ws, self.height, self.width, nH, nW, out=self._out(x))
         return y
 
+def compile_attention(model, mode='reduce-overhead'):
+    '''
+    用torch.compile (TorchInductor) 编译CBAM、DAM、BDAM的forward：注意力计算、attn(x) * x 的逐元素乘法
+    以及BDAM的窗口划分/还原都在同一编译区域内，可融合为少量kernel
+    BDAM内部的DAM随BDAM一起编译，不再单独编译；编译区域内不使用推理缓存（见_inference_cache_enabled）
+    只替换各模块的forward，模块结构与state_dict保持不变；需要torch>=2.0，否则直接返回原模型
+    '''
+    if not hasattr(torch, 'compile'):
+        print('torch.compile requires torch>=2.0, skipping attention compilation')
+        return model
+    inner = {id(m.dam) for m in model.modules() if isinstance(m, BDAM)}
+    for m in model.modules():
+        if isinstance(m, (CBAM, DAM, BDAM)) and id(m) not in inner:
+            m.forward = torch.compile(m.forward, mode=mode)
+    return model
+
+def fuse_layers(model):
+    '''
+    遍历model的所有模块，将BN层融合进卷积（Model.fuse与fuse_model共用）：
+        Conv : Conv.fuse_conv_bn
+        BottleneckCSP : BottleneckCSP.fuse（concat之后的BN融合进cv3、cv2）
+    bn已融合（nn.Identity）或已被旧版融合删除的模块跳过
+    '''
+    for m in list(model.modules()):
+        if type(m) is Conv and isinstance(getattr(m, 'bn', None), nn.BatchNorm2d):
+            m._non_persistent_buffers_set = set()  # pytorch 1.6.0 compatability
+            m.fuse_conv_bn()  # 融合BN到conv，bn替换为nn.Identity，forward替换为fuseforward
+        elif type(m) is BottleneckCSP and isinstance(m.bn, nn.BatchNorm2d):
+            m.fuse()
+    return model
+
+def clear_cache(model):
+    '''
+    释放model中所有模块（BottleneckCSP、SpatialAttention、Concat、BDAM）的推理缓存，
+    回到训练模式（Model.train）时自动调用，也可在推理结束后手动调用以释放显存
+    '''
+    for m in model.modules():
+        if isinstance(m, _CacheModule):
+            m.clear_cache()
+    return model
+
+def fuse_model(model):
+    '''
+    推理前（加载权重之后）调用一次：
+        1. model.eval()
+        2. fuse_layers(model)：融合所有Conv与BottleneckCSP中的BN
+        3. 开启cudnn.benchmark，并将模型转为channels_last内存布局（输入图像也应转为channels_last，
+           BottleneckCSP、Concat、BDAM的推理缓存会沿用输入的内存布局）
+    用法：
+        model = fuse_model(model)
+        y = model(img.contiguous(memory_format=torch.channels_last))
+    '''
+    model.eval()
+    fuse_layers(model)
+    torch.backends.cudnn.benchmark = True
+    return model.to(memory_format=torch.channels_last)
+
 if __name__ == "__main__":
     x = torch.randn([4,256,64,64])
     m = BDAM(in_planes=256, width=64,height=64)
@@ -1,4 +1,5 @@
 import argparse
+import contextlib
 import logging
 import math
 import sys
@@ -11,11 +12,11 @@ logger = logging.getLogger(__name__)
 import torch
 import torch.nn as nn
 
-from models.common import Conv, Bottleneck, SPP, DWConv, Focus, BottleneckCSP, Concat, NMS,CBAM,DAM,BDAM
+from models.common import Conv, Bottleneck, SPP, DWConv, Focus, BottleneckCSP, Concat, NMS,CBAM,DAM,BDAM, fuse_layers, clear_cache
 from models.experimental import MixConv2d, CrossConv, C3
 from utils.general import check_anchor_order, make_divisible, check_file, set_logging
 from utils.torch_utils import (
-    time_synchronized, fuse_conv_and_bn, model_info, scale_img, initialize_weights, select_device)
+    time_synchronized, model_info, scale_img, initialize_weights, select_device)
 
 class Detect(nn.Module):  # 定义检测网络
     '''
@@ -163,6 +164,8 @@ class Model(nn.Module):
                        (24):Detect(...)
                        )
     '''
+    bf16 = False  # CPU上以bfloat16 autocast推理，由inference_mode()设置
+
     def __init__(self, cfg='yolov5s.yaml', ch=3, nc=None):  # model, input channels, number of classes
         super(Model, self).__init__()
         if isinstance(cfg, dict):  # 有预训练权重文件时cfg加载权重中保存的cfg字典内容；
@@ -220,24 +223,25 @@ class Model(nn.Module):
                 ->
                     if profile=True： return out_tensor
         '''
-        if augment:
-            img_size = x.shape[-2:]  # height, width
-            s = [1, 0.83, 0.67]  # scales
-            f = [None, 3, None]  # flips (2-ud, 3-lr)
-            y = []  # outputs
-            for si, fi in zip(s, f):
-                xi = scale_img(x.flip(fi) if fi else x, si)
-                yi = self.forward_once(xi)[0]  # forward
-                # cv2.imwrite('img%g.jpg' % s, 255 * xi[0].numpy().transpose((1, 2, 0))[:, :, ::-1])  # save
-                yi[..., :4] /= si  # de-scale
-                if fi == 2:
-                    yi[..., 1] = img_size[0] - yi[..., 1]  # de-flip ud
-                elif fi == 3:
-                    yi[..., 0] = img_size[1] - yi[..., 0]  # de-flip lr
-                y.append(yi)
-            return torch.cat(y, 1), None  # augmented inference, train
-        else:
-            return self.forward_once(x, profile)  # single-scale inference, train
+        with torch.autocast(device_type='cpu', dtype=torch.bfloat16) if self.bf16 else contextlib.nullcontext():
+            if augment:
+                img_size = x.shape[-2:]  # height, width
+                s = [1, 0.83, 0.67]  # scales
+                f = [None, 3, None]  # flips (2-ud, 3-lr)
+                y = []  # outputs
+                for si, fi in zip(s, f):
+                    xi = scale_img(x.flip(fi) if fi else x, si)
+                    yi = self.forward_once(xi)[0]  # forward
+                    # cv2.imwrite('img%g.jpg' % s, 255 * xi[0].numpy().transpose((1, 2, 0))[:, :, ::-1])  # save
+                    yi[..., :4] /= si  # de-scale
+                    if fi == 2:
+                        yi[..., 1] = img_size[0] - yi[..., 1]  # de-flip ud
+                    elif fi == 3:
+                        yi[..., 0] = img_size[1] - yi[..., 0]  # de-flip lr
+                    y.append(yi)
+                return torch.cat(y, 1), None  # augmented inference, train
+            else:
+                return self.forward_once(x, profile)  # single-scale inference, train
 
     def forward_once(self, x, profile=False):
         '''
@@ -272,7 +276,11 @@ class Model(nn.Module):
                 dt.append((time_synchronized() - t) * 100)
                 print('%10.1f%10.0f%10.1fms %-40s' % (o, m.np, dt[-1], m.type))
 
-            x = m(x)  # run ，前向计算网络每层；m不为concat/Detect时直接前向计算，否则先更改x为待计算的对应层数的前向计算结果，再进行Concat/Detect
+            if self.bf16 and isinstance(m, Detect):  # Detect退出bfloat16 autocast，在fp32下解码框坐标（bf16在512~640范围内步长为4px）
+                with torch.autocast(device_type='cpu', enabled=False):
+                    x = m([xi.float() for xi in x])
+            else:
+                x = m(x)  # run ，前向计算网络每层；m不为concat/Detect时直接前向计算，否则先更改x为待计算的对应层数的前向计算结果，再进行Concat/Detect
             # m.i = 0/1/2/3/...../24; m.i表示当前第几个标准函数层
             # 把需要Concat/Detect的层数前向计算结果保存在y list中
             # 例：self.save=[6, 4, 14, 10, 17, 20, 23] ;y = [None,None,None,None,第四层的前向计算结果,None,第六层的前向计算结果......]
@@ -332,19 +340,40 @@ class Model(nn.Module):
         <class 'torch.nn.modules.activation.Hardswish'>
         ...
         '''
-        for m in self.model.modules():
-            if type(m) is Conv and hasattr(m, 'bn'):  # 如果函数层名为Conv标准卷积层，且同时 层中包含‘bn’属性名
-                m._non_persistent_buffers_set = set()  # pytorch 1.6.0 compatability
-                m.conv = fuse_conv_and_bn(m.conv, m.bn)  # update conv
-                delattr(m, 'bn')  # remove batchnorm 将'bn'属性删除
-                m.forward = m.fuseforward  # update forward
+        fuse_layers(self.model)
         self.info()
         return self
 
+    def train(self, mode=True):
+        if mode:  # 回到训练模式时关闭bfloat16 autocast，并释放推理缓存
+            self.bf16 = False
+            clear_cache(self)
+        return super(Model, self).train(mode)
+
+    def inference_mode(self):
+        '''
+        仅推理使用的低精度设置：
+            GPU : 整个模型转为FP16 (model.half())，输入图像也需转为half
+            CPU : Detect之前的层在torch.autocast('cpu', dtype=torch.bfloat16)中计算，卷积与1×1矩阵乘使用bfloat16；
+                  Detect在fp32下计算，输出为fp32。调用model.train()时自动关闭
+        BottleneckCSP、SpatialAttention等模块中的推理缓存在精度改变时会自动重新分配
+        注意：本函数不会关闭梯度计算，推理缓存只在无梯度时启用，前向计算需放在 torch.no_grad() 或 torch.inference_mode() 中：
+            model.inference_mode()
+            with torch.no_grad():
+                pred = model(img)[0]
+        '''
+        self.eval()
+        if next(self.parameters()).device.type == 'cpu':
+            self.bf16 = True
+        else:
+            self.half()
+        return self
+
     def add_nms(self):  # fuse model Conv2d() + BatchNorm2d() layers
         if type(self.model[-1]) is not NMS:  # if missing NMS
             print('Adding NMS module... ')
             m = NMS()  # module
+            m.angle = self.model[-1].angle  # Detect输出中类别之后的角度列数
             m.f = -1  # from
             m.i = self.model[-1].i + 1  # index
             self.model.add_module(name='%s' % m.i, module=m)  # add